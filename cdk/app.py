@@ -1,26 +1,45 @@
 #!/usr/bin/env python3
-from core_stack import CoreResourcesStack
+from core_stack import CoreResourcesStack, coerce_bool
 from demo_stack import DemoResourcesStack
-from aws_cdk import App, Aspects
-from cdk_nag import AwsSolutionsChecks
+from aws_cdk import Annotations, App, Aspects
 
 
 
 app = App()
 
+#Returns True if the boolean context variable is set to True (or a string 'true'), the same way as the stack reads its boolean context variables.
+#Context variables passed in at the command line are received as strings, whereas those in cdk.json can be booleans
+#Any other value is reported as an error (and treated as False), rather than silently ignored.
+def context_flag(name):
+    value = app.node.try_get_context(name)
+    if value is None:
+        return False
+    flag = coerce_bool(value)
+    if flag is None:
+        Annotations.of(app).add_error(f'Invalid value for {name}. The value must be a boolean or a string "true" or "false".')
+        return False
+    return flag
+
 # Use the cdk-nag AwsSolutions Pack to validate your stack.
 # Ref: https://github.com/cdklabs/cdk-nag/blob/main/RULES.md#awssolutions
-Aspects.of(app).add(AwsSolutionsChecks(verbose = True))
+# The checks visit every construct in the app, so they are only run when the context variable run_cdk_nag is set to True (e.g. for CI/release builds)
+# cdk_nag is imported only in that case. The stacks are told whether to add their cdk-nag suppressions with the run_cdk_nag argument.
+run_cdk_nag = context_flag("run_cdk_nag")
+if run_cdk_nag:
+    from cdk_nag import AwsSolutionsChecks
+    Aspects.of(app).add(AwsSolutionsChecks(verbose = False))
 
 #Core stack. This has the core set up like the Lambda function, DynamoDB tables etc.
 #There will be only one instance of this stack no matter how many buckets' prefix level keys are being enforced
 #But this stack will contain nested stacks (one each for each bucket whose KMS keys are being enforced.
-core_stack = CoreResourcesStack(app, "S3PrefixLevelKeys")
+core_stack = CoreResourcesStack(app, "S3PrefixLevelKeys", run_cdk_nag = run_cdk_nag)
 
-#Demo stack - For a non-versioned bucket
-demo_unversioned = DemoResourcesStack(app, f"DemoForS3PrefixLevelKeys1", bucket_versioned = False)
+#The demo stacks are only created if the context variable deploy_demos is set to True
+if context_flag("deploy_demos"):
+    #Demo stack - For a non-versioned bucket
+    demo_unversioned = DemoResourcesStack(app, f"DemoForS3PrefixLevelKeys1", bucket_versioned = False, run_cdk_nag = run_cdk_nag)
 
-#If you want to test out a versioned bucket, deploy the stack DemoForS3PrefixLevelKeys2
-demo_versioned   = DemoResourcesStack(app, f"DemoForS3PrefixLevelKeys2",   bucket_versioned = True)
+    #If you want to test out a versioned bucket, deploy the stack DemoForS3PrefixLevelKeys2
+    demo_versioned   = DemoResourcesStack(app, f"DemoForS3PrefixLevelKeys2",   bucket_versioned = True,  run_cdk_nag = run_cdk_nag)
 
 app.synth()
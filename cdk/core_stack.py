@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+#Use orjson to parse the input files if it is installed, as it is faster than the standard json library.
+#Both accept bytes, so the files can be read in binary mode either way.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
 
-import json
 from constructs import Construct
 from aws_cdk import (
     aws_iam as iam,
     aws_kms as kms,
-    aws_s3 as s3,
     aws_lambda as lambda_,
     aws_dynamodb as dynamodb,
     aws_sqs as sqs,
-    custom_resources as custom_resources,
     aws_cloudwatch as cloudwatch,
     aws_cloudwatch_actions as cloudwatch_actions,
     aws_sns as sns,
     aws_sns_subscriptions as sns_subscriptions,
+    AssetHashType,
     CfnOutput,
     Duration,
     RemovalPolicy,
@@ -27,7 +36,34 @@ from integration_stack import BucketIntegrationStack
 from aws_cdk.custom_resources import Provider
 from aws_cdk.aws_lambda import AdotLambdaExecWrapper, AdotLayerVersion, AdotLambdaLayerPythonSdkVersion
 
-from cdk_nag import NagSuppressions
+#Files that are not needed in the Lambda function assets. Excluding them keeps them out of the asset hash and the zip file.
+_LAMBDA_ASSET_EXCLUDES = ["__pycache__", "*.pyc", "*.dist-info", "tests"]
+
+#Both Lambda functions run on arm64 (Graviton). Their code is pure python, so it runs there as is. The ADOT layer (if enabled) is picked for this architecture by CDK.
+_LAMBDA_ARCHITECTURE = lambda_.Architecture.ARM_64
+
+#Regex used to validate the error_notification_email context variable
+_EMAIL_RE = re.compile(r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$")
+
+#Helper function to convert a boolean context variable to a bool. It is also used by app.py, so that every boolean context variable is read the same way.
+#We need to check for both string and boolean values because while boolean values can be passed in via cdk.json, it cannot be passed in at the command line. All parameters passed in from the command line are received as strings
+#Returns None if the value is neither a boolean nor a string "true" or "false" (case insensitive)
+def coerce_bool(value) -> Optional[bool]:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return {'true': True, 'false': False}.get(value.lower())
+    return None
+
+#Reads an integer context variable, or returns the default if it is not set. An invalid value (already reported by
+#validate_context_variables) also gives the default, so that synthesis goes on and reports all the errors.
+def _coerce_int(value, default: int) -> int:
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
 
 
 #This stack is the core stack that contains the necessary resources to enforce prefix level KMS keys.
@@ -42,30 +78,58 @@ from cdk_nag import NagSuppressions
 #7. A Lambda function that will keep the mapping table upto date with the input files referred to in the "input_file_name" context variable
 #8. One Integration Stack for each bucket that needs to be covered by this stack.
 class CoreResourcesStack(Stack):
-    def __init__(self, scope: Construct, id: str, **kwargs) -> None:
+    #All the context variables used by this stack. These are read once (see self._ctx below) rather than
+    #calling self.node.try_get_context every time a value is needed.
+    _CONTEXT_KEYS = (
+        "no_error_emails",
+        "retain_ddb_logs_table",
+        "no_buckets_configured",
+        "error_notification_email",
+        "input_file_name",
+        "max_receive_count",
+        "enforcement_lambda_memory",
+        "enable_adot",
+        "sqs_batch_size",
+        "sqs_batch_window_seconds",
+        "sqs_max_concurrency",
+        "mapping_table_pitr"
+    )
+
+    def __init__(self, scope: Construct, id: str, run_cdk_nag = False, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
+        #cdk-nag suppressions are added only when the cdk-nag checks are run. The nested integration stacks read this too.
+        self.run_cdk_nag = run_cdk_nag
+
+        #Read all the context variables once
+        self._ctx = {k: self.node.try_get_context(k) for k in self._CONTEXT_KEYS}
+
+        #Cache of the json files read by read_json_file, keyed by absolute file path
+        self._json_cache = {}
+
         #Validate all the context variables
         self.validate_context_variables()
 
         #This input file provides a list of bucket names and the json file that contains the prefix->KMS Key mapping for that bucket
-        self.input_file_name = self.node.try_get_context("input_file_name")
+        self.input_file_name = self._ctx["input_file_name"]
 
         ############################################
         #                DDB Tables                #
         ############################################
         #Create a DynamoDB Table that stores the mapping between prefixes and KMS keys
+        #The contents of this table can be rebuilt from the input files, so point in time recovery is enabled only if the context variable mapping_table_pitr is set to True
+        mapping_table_pitr = bool(coerce_bool(self._ctx["mapping_table_pitr"]))
         self.ddb_mapping_table = dynamodb.Table(
             self, "PrefixLevelKeysMappingTable",
             partition_key = dynamodb.Attribute(name = "bucket_name", type = dynamodb.AttributeType.STRING),
             sort_key = dynamodb.Attribute(name = "prefix", type = dynamodb.AttributeType.STRING),
             removal_policy = RemovalPolicy.DESTROY,
             billing_mode = dynamodb.BillingMode.PAY_PER_REQUEST,
-            point_in_time_recovery=True
+            point_in_time_recovery=mapping_table_pitr
         )
 
-        retain_ddb_logs_table = self.node.try_get_context("retain_ddb_logs_table")
-        if retain_ddb_logs_table and (retain_ddb_logs_table == True or retain_ddb_logs_table.lower() == 'true'): #We need to check for both string and boolean values because while boolean values can be passed in via cdk.json, it cannot be passed in at the command line. All parameters passed in from the command line are received as strings
+        retain_ddb_logs_table = self._ctx["retain_ddb_logs_table"]
+        if coerce_bool(retain_ddb_logs_table):
             Annotations.of(self).add_info("DDB Logs table will be retained even after stack deletion")
             logs_removal_policy = RemovalPolicy.RETAIN_ON_UPDATE_OR_DELETE
         else:
@@ -86,6 +150,15 @@ class CoreResourcesStack(Stack):
         ####################################################
         #            Enforce Encryption Lambda             #
         ####################################################
+        #The ADOT layer adds to the cold start time of the Lambda functions. So it is added only if the context variable enable_adot is set to True.
+        if coerce_bool(self._ctx["enable_adot"]):
+            adot_instrumentation = lambda_.AdotInstrumentationConfig(
+                layer_version=AdotLayerVersion.from_python_sdk_layer_version(AdotLambdaLayerPythonSdkVersion.LATEST),
+                exec_wrapper=AdotLambdaExecWrapper.INSTRUMENT_HANDLER
+            )
+        else:
+            adot_instrumentation = None
+
         #Create a Lambda function to Enforce the right key on the S3 objects.
         #The Lambda function will be triggered when a new S3 object is added to the bucket.
 
@@ -94,45 +167,47 @@ class CoreResourcesStack(Stack):
         # and the resources are not narrowed down
         self.enforce_encryption_lambda_role = iam.Role(self, "EnforceEncryptionLambdaRole",
             assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"))
+        #The integration stacks read the role's ARN and name, so they are looked up once here
+        self.enforce_encryption_lambda_role_arn = self.enforce_encryption_lambda_role.role_arn
+        self.enforce_encryption_lambda_role_name = self.enforce_encryption_lambda_role.role_name
+
+        #CPU is allocated in proportion to memory, so a larger memory size shortens cold starts (ADOT layer and boto3 initialization).
+        #The default can be overridden with the enforcement_lambda_memory context variable.
+        enforcement_lambda_memory = _coerce_int(self._ctx["enforcement_lambda_memory"], 1024)
 
         self.enforce_encryption_lambda_fn = lambda_.Function(self, "EnforcePrefixLevelEncryption",
                 runtime=lambda_.Runtime.PYTHON_3_12,
+                architecture=_LAMBDA_ARCHITECTURE,
                 handler="s3_encrypt.lambda_handler",
-                code=lambda_.Code.from_asset("resources/fix_encryption"),
+                code=lambda_.Code.from_asset("resources/fix_encryption", asset_hash_type = AssetHashType.SOURCE, exclude = _LAMBDA_ASSET_EXCLUDES),
                 environment = {
                     "ddb_mapping_table" : self.ddb_mapping_table.table_name,
                     "ddb_log_table" : self.ddb_log_table.table_name
                     },
-                adot_instrumentation=lambda_.AdotInstrumentationConfig(
-                    layer_version=AdotLayerVersion.from_python_sdk_layer_version(AdotLambdaLayerPythonSdkVersion.LATEST),
-                    exec_wrapper=AdotLambdaExecWrapper.INSTRUMENT_HANDLER
-                ),
+                adot_instrumentation = adot_instrumentation,
                 timeout = Duration.seconds(60*15),
+                memory_size = enforcement_lambda_memory,
                 role = self.enforce_encryption_lambda_role
             )
 
-        #Build log group and log stream ARNs
-        log_group_arn = f"arn:{self.partition}:logs:{self.region}:{self.account}:log-group:/aws/lambda/{self.stack_name}-EnforcePrefixLevelEncryption*"
-        log_stream_arn = f"arn:{self.partition}:logs:{self.region}:{self.account}:log-group:/aws/lambda/{self.stack_name}-EnforcePrefixLevelEncryption*:log-stream:*"
-
-        #Add a policy to the lambda execution role to be able to send logs to CloudWatch
-        self.enforce_encryption_lambda_fn.add_to_role_policy(
-            iam.PolicyStatement(
-                actions = ["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"],
-                resources = [log_group_arn, log_stream_arn]
-            )
-        )
-
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            '/S3PrefixLevelKeys/EnforceEncryptionLambdaRole/DefaultPolicy/Resource',
-            [
-                {
-                'id': 'AwsSolutions-IAM5',
-                'reason': 'The IAM policy uses "*" for telemetry events but this is added by default by the ADOTLayer in CDK. * is also used in log-groups and log-strreams as it is not posible to know the full name before the stack synthesizes',
-                },
+        #Add a policy to the lambda execution role to be able to send logs to CloudWatch, query the DDB Mapping table and insert data into the DDB Logs table.
+        #All the statements are added as a single inline policy.
+        self.enforce_encryption_lambda_policy = iam.Policy(self, "EnforcerPolicy",
+            statements = [
+                self._cw_logs_statement("EnforcePrefixLevelEncryption"),
+                iam.PolicyStatement(
+                    actions = ["dynamodb:Query"],
+                    resources = [self.ddb_mapping_table.table_arn]
+                ),
+                iam.PolicyStatement(
+                    actions = ["dynamodb:BatchWriteItem"],
+                    resources = [self.ddb_log_table.table_arn]
+                )
             ]
         )
+        self.enforce_encryption_lambda_role.attach_inline_policy(self.enforce_encryption_lambda_policy)
+        #Unlike add_to_role_policy, an attached policy does not make the function depend on it. So add that dependency explicitly.
+        self.enforce_encryption_lambda_fn.node.add_dependency(self.enforce_encryption_lambda_policy)
 
         #########################################################
         #        DDB Mapping Table Initialization Lambda        #
@@ -146,85 +221,89 @@ class CoreResourcesStack(Stack):
 
         self.ddb_init_lambda_fn = lambda_.Function(self, "MappingTableInitialization",
                 runtime=lambda_.Runtime.PYTHON_3_12,
+                architecture=_LAMBDA_ARCHITECTURE,
                 handler="ddb_custom_resource.on_event",
-                code=lambda_.Code.from_asset("resources/custom_resources"),
-                adot_instrumentation=lambda_.AdotInstrumentationConfig(
-                    layer_version=AdotLayerVersion.from_python_sdk_layer_version(AdotLambdaLayerPythonSdkVersion.LATEST),
-                    exec_wrapper=AdotLambdaExecWrapper.INSTRUMENT_HANDLER
-                ),
+                code=lambda_.Code.from_asset("resources/custom_resources", asset_hash_type = AssetHashType.SOURCE, exclude = _LAMBDA_ASSET_EXCLUDES),
+                adot_instrumentation = adot_instrumentation,
                 timeout = Duration.seconds(60),
+                memory_size = 512,
                 role = self.ddb_init_lambda_fn_role
             )
 
-        #Build log group and log stream ARNs
-        log_group_arn = f"arn:{self.partition}:logs:{self.region}:{self.account}:log-group:/aws/lambda/{self.stack_name}-MappingTableInitialization*"
-        log_stream_arn = f"arn:{self.partition}:logs:{self.region}:{self.account}:log-group:/aws/lambda/{self.stack_name}-MappingTableInitialization*:log-stream:*"
-
-        #Add a policy to the lambda execution role to be able to send logs to CloudWatch
-        self.ddb_init_lambda_fn.add_to_role_policy(
-            iam.PolicyStatement(
-                actions = ["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"],
-                #Add specific log groups and log streams - yet to debug why specific log groups do not work TBD
-                resources = [log_group_arn, log_stream_arn]
-            )
-        )
-
-        #Grant the Lambda function permissions to query, update, delete items from the DDB table.
-        self.ddb_init_lambda_fn.add_to_role_policy(
-            iam.PolicyStatement(
-                actions = ["dynamodb:Query", "dynamoDB:BatchWriteItem", "dynamodb:UpdateItem", "dynamodb:DeleteItem"],
-                resources = [self.ddb_mapping_table.table_arn]
-            )
+        #Add a policy to the lambda execution role to be able to send logs to CloudWatch and to query the DDB table and write (put and delete) its items in batches.
+        #All the statements are added as a single inline policy.
+        self.ddb_init_lambda_fn_policy = iam.Policy(self, "MappingTableInitializationPolicy",
+            statements = [
+                self._cw_logs_statement("MappingTableInitialization"),
+                iam.PolicyStatement(
+                    actions = ["dynamodb:Query", "dynamodb:BatchWriteItem"],
+                    resources = [self.ddb_mapping_table.table_arn]
+                )
+            ]
         )
+        self.ddb_init_lambda_fn_role.attach_inline_policy(self.ddb_init_lambda_fn_policy)
+        self.ddb_init_lambda_fn.node.add_dependency(self.ddb_init_lambda_fn_policy)
 
         self.ddb_init_provider = Provider(scope=self, 
                             id=f'DDBMappingInitProvider', 
                             on_event_handler=self.ddb_init_lambda_fn)
 
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            '/S3PrefixLevelKeys/MappingTableInitializationLambdaRole/DefaultPolicy/Resource',
-            [
-                {
-                'id': 'AwsSolutions-IAM5',
-                'reason': 'The IAM policy uses "*" for telemetry events but this is added by default by the ADOTLayer in CDK. * is also used in log-groups and log-strreams as it is not posible to know the full name before the stack synthesizes',
-                },
-            ]
-        )
-
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            '/S3PrefixLevelKeys/DDBMappingInitProvider/framework-onEvent/ServiceRole/Resource',
-            [
-                {
-                'id': 'AwsSolutions-IAM4',
-                'reason': 'The Managed policy administered by AWS does not restrict scope, but it is used by the CDK construct and so outide the scope of this code',
-                },
-            ]
-        )
-
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            '/S3PrefixLevelKeys/DDBMappingInitProvider/framework-onEvent/ServiceRole/DefaultPolicy/Resource',
-            [
-                {
-                'id': 'AwsSolutions-IAM5',
-                'reason': 'The Managed policy administered by AWS does not restrict scope and uses *, but it is used by the CDK construct and so outide the scope of this code',
-                },
-            ]
-        )
-
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            '/S3PrefixLevelKeys/DDBMappingInitProvider/framework-onEvent/Resource',
-            [
-                {
-                'id': 'AwsSolutions-L1',
-                'reason': 'The provider is defined in the CDK and it does not use python 3.12. But that is outside the scope of this code',
-                },
-            ]
-        )
-
+        #cdk-nag suppressions for the resources created above. These are collected as (path, suppressions) pairs and added in a single loop.
+        logs_suppression = {
+            'id': 'AwsSolutions-IAM5',
+            'reason': '* is used in log-groups and log-strreams as it is not posible to know the full name before the stack synthesizes',
+        }
+        adot_suppression = {
+            'id': 'AwsSolutions-IAM5',
+            'reason': 'The IAM policy uses "*" for telemetry events but this is added by default by the ADOTLayer in CDK.',
+        }
+        nag_suppressions = [
+            ('/S3PrefixLevelKeys/EnforcerPolicy/Resource', [logs_suppression]),
+            ('/S3PrefixLevelKeys/MappingTableInitializationPolicy/Resource', [logs_suppression]),
+            ('/S3PrefixLevelKeys/DDBMappingInitProvider/framework-onEvent/ServiceRole/Resource',
+                [
+                    {
+                    'id': 'AwsSolutions-IAM4',
+                    'reason': 'The Managed policy administered by AWS does not restrict scope, but it is used by the CDK construct and so outide the scope of this code',
+                    },
+                ]
+            ),
+            ('/S3PrefixLevelKeys/DDBMappingInitProvider/framework-onEvent/ServiceRole/DefaultPolicy/Resource',
+                [
+                    {
+                    'id': 'AwsSolutions-IAM5',
+                    'reason': 'The Managed policy administered by AWS does not restrict scope and uses *, but it is used by the CDK construct and so outide the scope of this code',
+                    },
+                ]
+            ),
+            ('/S3PrefixLevelKeys/DDBMappingInitProvider/framework-onEvent/Resource',
+                [
+                    {
+                    'id': 'AwsSolutions-L1',
+                    'reason': 'The provider is defined in the CDK and it does not use python 3.12. But that is outside the scope of this code',
+                    },
+                ]
+            ),
+        ]
+        #The ADOT layer adds its statements to the default policy of the roles
+        if adot_instrumentation:
+            nag_suppressions.append(('/S3PrefixLevelKeys/EnforceEncryptionLambdaRole/DefaultPolicy/Resource', [adot_suppression]))
+            nag_suppressions.append(('/S3PrefixLevelKeys/MappingTableInitializationLambdaRole/DefaultPolicy/Resource', [adot_suppression]))
+        if not mapping_table_pitr:
+            nag_suppressions.append(
+                ('/S3PrefixLevelKeys/PrefixLevelKeysMappingTable/Resource',
+                    [
+                        {
+                        'id': 'AwsSolutions-DDB3',
+                        'reason': 'The Mapping table can be rebuilt from the input files, so point in time recovery is not enabled by default. It can be enabled with the mapping_table_pitr context variable',
+                        },
+                    ]
+                )
+            )
+        if self.run_cdk_nag:
+            from cdk_nag import NagSuppressions
+            for path, suppressions in nag_suppressions:
+                NagSuppressions.add_resource_suppressions_by_path(self, path, suppressions)
 
         #---------------End of Lambda---------------
 
@@ -237,12 +316,8 @@ class CoreResourcesStack(Stack):
                                             enforce_ssl = True)
 
         #Create a dead letter queue construct to specify the max_receive_count
-        max_receive_count = self.node.try_get_context("max_receive_count")
-        if not max_receive_count:
-            max_receive_count = 1
-        else:
-            max_receive_count = int(max_receive_count)
-        
+        max_receive_count = _coerce_int(self._ctx["max_receive_count"], 1)
+
         self.dead_letter_queue_settings = sqs.DeadLetterQueue(max_receive_count=max_receive_count,
                                                      queue = self.dead_letter_queue)
 
@@ -277,7 +352,7 @@ class CoreResourcesStack(Stack):
                                 )
 
         self.sns_topic.grant_publish(iam.ServicePrincipal("cloudwatch.amazonaws.com"))
-        error_email_address = self.node.try_get_context("error_notification_email")
+        error_email_address = self._ctx["error_notification_email"]
         if error_email_address:
             self.sns_topic.add_subscription(sns_subscriptions.EmailSubscription(error_email_address))
 
@@ -289,26 +364,19 @@ class CoreResourcesStack(Stack):
         #################################################
         #               Permissions setup               #
         #################################################
-        #Grant the Lambda function permissions to query the DDB Mapping table.
-        self.enforce_encryption_lambda_fn.add_to_role_policy(
-            iam.PolicyStatement(
-                actions = ["dynamodb:Query"],
-                resources = [self.ddb_mapping_table.table_arn]
-            )
-        )
-
-        #Grant the Lambda function permissions to insert data into the DDB Logs table.
-        self.enforce_encryption_lambda_fn.add_to_role_policy(
-            iam.PolicyStatement(
-                actions = ["dynamodb:PutItem"],
-                resources = [self.ddb_log_table.table_arn]
-            )
-        )
-
         #Create an event source from SQS to Enforcement Lambda function
+        #Larger batches mean fewer Lambda invocations under bursty loads. Both can be overridden with the context variables
+        #sqs_batch_size (up to 10000) and sqs_batch_window_seconds (up to 300).
+        #The Lambda timeout and the queue's visibility timeout (both 15 minutes) leave enough time to process a full batch.
+        sqs_batch_size = _coerce_int(self._ctx["sqs_batch_size"], 100)
+        sqs_batch_window_seconds = _coerce_int(self._ctx["sqs_batch_window_seconds"], 30)
+        #Cap the number of concurrent Lambda invocations by the event source (between 2 and 1000) so that the reads on the mapping table stay predictable.
+        #This can be overridden with the context variable sqs_max_concurrency.
+        sqs_max_concurrency = _coerce_int(self._ctx["sqs_max_concurrency"], 10)
         event_source = SqsEventSource(self.s3_objects_queue,
-                                        batch_size=10,
-                                        max_batching_window=Duration.seconds(15),
+                                        batch_size=sqs_batch_size,
+                                        max_batching_window=Duration.seconds(sqs_batch_window_seconds),
+                                        max_concurrency=sqs_max_concurrency,
                                         report_batch_item_failures=True)
 
         #Grant the SQS queue permissions to send messages to the Lambda function. Needed for event notifications to work.
@@ -333,12 +401,40 @@ class CoreResourcesStack(Stack):
             input_data = self.read_json_file(self.input_file_name)
             self.bucket_integration_stacks = []
 
+            #Read the mapping data for all the buckets in parallel, as the file reads are independent of one another
+            mapping_data_map = {}
+            if input_data:
+                with ThreadPoolExecutor(max_workers = min(32, len(input_data))) as executor:
+                    mapping_data_map = dict(zip(input_data, executor.map(lambda b: self.read_json_file(input_data[b]["mapping_file_name"]), input_data)))
+
+                #The bucket notifications handler that CDK adds to each integration stack uses this single role
+                #instead of creating one role (and managed policy attachment) per bucket.
+                self.shared_notifications_role = iam.Role(self, "BucketNotificationsHandlerRole",
+                    assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+                    managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")])
+
             #Create an "Integration" stack for each bucket that is protected by this app.
             for bucket_name in input_data:
-                #Read the mapping data
-                mapping_data = self.read_json_file(input_data[bucket_name]["mapping_file_name"])
                 #Instantiate the stack
-                self.bucket_integration_stacks.append(BucketIntegrationStack(self, f"BucketIntegrationStack_{bucket_name}", bucket_name=bucket_name, mapping_data = mapping_data))
+                self.bucket_integration_stacks.append(BucketIntegrationStack(self, f"BucketIntegrationStack_{bucket_name}", bucket_name=bucket_name, mapping_data = mapping_data_map[bucket_name]))
+
+            #The default policy of the shared role is added by the integration stacks above, so the suppressions are added after them
+            if input_data and self.run_cdk_nag:
+                from cdk_nag import NagSuppressions
+                NagSuppressions.add_resource_suppressions(
+                    self.shared_notifications_role,
+                    suppressions = [
+                        {
+                        'id': 'AwsSolutions-IAM4',
+                        'reason': 'The add_event_notification function generates the Lambda function that uses this role, and the role needs the basic execution permissions of that function. But that is outside the scope of this code',
+                        },
+                        {
+                        'id': 'AwsSolutions-IAM5',
+                        'reason': "The add_event_notification function adds the default policy for this role with '*' resources. But that is outside the scope of this code",
+                        },
+                    ],
+                    apply_to_children = True
+                )
         #-------------End of Bucket Level setup-----------
 
         ###################################################
@@ -350,27 +446,53 @@ class CoreResourcesStack(Stack):
         if not error_email_address:
             CfnOutput(self, "SNSTopicARN", value=self.sns_topic.topic_arn)
 
+    #Helper function to build the policy statement that allows a lambda function to send logs to CloudWatch.
+    #logical_prefix is the construct id of the function, which is part of the function's (and hence the log group's) name.
+    def _cw_logs_statement(self, logical_prefix):
+        #Build log group and log stream ARNs
+        log_group_arn = f"arn:{self.partition}:logs:{self.region}:{self.account}:log-group:/aws/lambda/{self.stack_name}-{logical_prefix}*"
+        log_stream_arn = f"{log_group_arn}:log-stream:*"
+
+        return iam.PolicyStatement(
+            actions = ["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"],
+            resources = [log_group_arn, log_stream_arn]
+        )
+
     #Helper function to read any json file
+    #Files are parsed only once per synth. If more than one bucket uses the same mapping file, the cached data is returned.
     def read_json_file(self, file_name):
+        cache_key = os.path.abspath(file_name)
+        if cache_key in self._json_cache:
+            return self._json_cache[cache_key]
         try:
             #Add a try clause to catch any errors in opening files and raise an exception
-            with open(file_name, 'r') as infile:    
-                data = json.load(infile)
-                return data
+            with open(file_name, 'rb') as infile:
+                data = _json_loads(infile.read())
         except Exception as e:
             raise ValueError(f"Error in reading file {file_name}. Error: {e}")
+        self._json_cache[cache_key] = data
+        return data
 
+    #All the validators below take the name and the (already fetched) value of the context variable, so validation is
+    #a single pass over self._ctx without going back to the construct tree.
     def validate_context_variables(self):
-                
+        ctx = self._ctx
+
         #Stand alone checks on each context variable on its own
-        if not self.boolean_validate("no_error_emails"): return False
-        if not self.boolean_validate("retain_ddb_logs_table"): return False
-        if not self.boolean_validate("no_buckets_configured"): return False
+        if not self.boolean_validate("no_error_emails", ctx["no_error_emails"]): return False
+        if not self.boolean_validate("retain_ddb_logs_table", ctx["retain_ddb_logs_table"]): return False
+        if not self.boolean_validate("no_buckets_configured", ctx["no_buckets_configured"]): return False
+        if not self.boolean_validate("enable_adot", ctx["enable_adot"]): return False
+        if not self.boolean_validate("mapping_table_pitr", ctx["mapping_table_pitr"]): return False
 
-        if not self.email_validate("error_notification_email"): return False
-        #if not self.file_validate("input_file_name"): return False
+        if not self.email_validate("error_notification_email", ctx["error_notification_email"]): return False
+        #if not self.file_validate("input_file_name", ctx["input_file_name"]): return False
 
-        #if not self.is_integer("max_receive_count"): return False
+        if not self.is_integer("max_receive_count", ctx["max_receive_count"], min_value = 1, max_value = 1000): return False
+        if not self.is_integer("enforcement_lambda_memory", ctx["enforcement_lambda_memory"], min_value = 128, max_value = 10240): return False
+        if not self.is_integer("sqs_batch_size", ctx["sqs_batch_size"], min_value = 1, max_value = 10000): return False
+        if not self.is_integer("sqs_batch_window_seconds", ctx["sqs_batch_window_seconds"], min_value = 0, max_value = 300): return False
+        if not self.is_integer("sqs_max_concurrency", ctx["sqs_max_concurrency"], min_value = 2, max_value = 1000): return False
 
         #Checks on combinations of context variables:
         #input_file_name and no_buckets_configured
@@ -380,7 +502,7 @@ class CoreResourcesStack(Stack):
                     "Please note that if you already have some buckets configured and you deploy the stack again without the input_file_name variable, it will delete existing configurations too. So please be careful."
                     "The no_buckets_configured option is usually used only the very first time. Once you start configuring buckets, you might not want to skip passing in the input_file_name parameter\n"
         )
-        if not self.either_or_validate("input_file_name", "no_buckets_configured", custom_message = cust_msg): return False
+        if not self.either_or_validate("input_file_name", ctx["input_file_name"], "no_buckets_configured", ctx["no_buckets_configured"], custom_message = cust_msg): return False
 
         #error_notification_email and no_error_emails
         cust_msg = (
@@ -388,17 +510,13 @@ class CoreResourcesStack(Stack):
                     "If you do not want to receive emails (probably because you want to handle errors differently), please pass in the no_error_emails variable with the string 'true' or a boolean True.\n"
                     "But in such a case, make sure that the SNS topic created in this stack is subscribed to for any error handling."
         )
-        if not self.either_or_validate("error_notification_email", "no_error_emails", custom_message = cust_msg): return False
+        if not self.either_or_validate("error_notification_email", ctx["error_notification_email"], "no_error_emails", ctx["no_error_emails"], custom_message = cust_msg): return False
 
         #If we are here, then all checks have passed. So return True.
         return True
 
-    def file_validate(self, context_var_name, custom_message = ""):
-        context_var_value = self.node.try_get_context(context_var_name)
-        print(f"validating file {context_var_value}")
+    def file_validate(self, context_var_name, context_var_value, custom_message = ""):
         if context_var_value:
-            print("Checking file")
-            print(os.path.isfile(context_var_value))
             if os.path.isfile(context_var_value):
                 return True
             else:
@@ -409,10 +527,9 @@ class CoreResourcesStack(Stack):
         else:
             return True
 
-    def email_validate(self, context_var_name, custom_message = ""):
-        context_var_value = self.node.try_get_context(context_var_name)
+    def email_validate(self, context_var_name, context_var_value, custom_message = ""):
         if context_var_value:
-            if re.match(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)", context_var_value):
+            if _EMAIL_RE.match(context_var_value):
                 return True
             else:
                 error_msg = f'Invalid value for {context_var_name}. The value must be a valid email address. {custom_message}'
@@ -421,25 +538,17 @@ class CoreResourcesStack(Stack):
         else:
             return True
 
-    # This function takes in two arguments. The first one is the name of the context variable and the second one is a boolean context variable,
+    # This function takes in two context variables (name and value of each). The first one is any context variable and the second one is a boolean context variable,
     # which when set to True, the first context variable needs to be skipped. This function tests the valid combinations of these two variables:
     # 1. The boolean is set to True (or a string 'true') and the first context variable is not set.
     # 2. The boolean is not set (or set to False or a string 'false') and the first context variable is set.
     # This is used for the following two combinations:
     # - input_file_name and no_buckets_configured
     # - error_notification_email and no_error_emails
-    def either_or_validate(self, context_var_name, context_var_name_bool, custom_message = ""):
-        context_var_value = self.node.try_get_context(context_var_name)
-        context_var_value_bool = self.node.try_get_context(context_var_name_bool)
-
+    def either_or_validate(self, context_var_name, context_var_value, context_var_name_bool, context_var_value_bool, custom_message = ""):
         if context_var_value_bool:
-            if (context_var_value_bool == True or
-                context_var_value_bool.lower() == 'true'):
-                context_bool = True
-            elif (context_var_value_bool == False or
-                context_var_value_bool.lower() == 'false'):
-                context_bool = False
-            else:
+            context_bool = coerce_bool(context_var_value_bool)
+            if context_bool is None:
                 error_msg = f"Invalid value for {context_var_name_bool}. It must be either True or False"
                 Annotations.of(self).add_error(error_msg)
                 return False
@@ -462,13 +571,9 @@ class CoreResourcesStack(Stack):
             Annotations.of(self).add_error(error_msg)
             return False
 
-    def boolean_validate(self, context_var_name, custom_message = ""):
-        context_var_value = self.node.try_get_context(context_var_name)
+    def boolean_validate(self, context_var_name, context_var_value, custom_message = ""):
         if context_var_value:
-            if (context_var_value == True or
-                context_var_value.lower() == 'true' or
-                context_var_value == False or
-                context_var_value.lower() == 'false'): #We need to check for both string and boolean values because while boolean values can be passed in via cdk.json, it cannot be passed in at the command line. All parameters passed in from the command line are received as strings
+            if coerce_bool(context_var_value) is not None:
                 return True
             else:
                 error_msg = f'Invalid value for {context_var_name}. The value must be a boolean or a string "true" or "false". {custom_message}'
@@ -477,15 +582,15 @@ class CoreResourcesStack(Stack):
         else:
             return True
 
-    def is_integer(self, context_var_name, custom_message = ""):
-        context_var_value = self.node.try_get_context(context_var_name)
-        if context_var_value:
+    #An unset value (None or an empty string) is valid, as the default is used for it. Zero is a value like any other.
+    def is_integer(self, context_var_name, context_var_value, custom_message = "", min_value = 1, max_value = 1000):
+        if context_var_value is not None and context_var_value != "":
             try: 
                 val = int(context_var_value)
-                if not (val >= 1 and val <= 1000):
-                    raise ValueError(f"{context_var_name} must be an integer value between 1 and 1000")
-            except ValueError:
-                error_msg = f'Invalid value for {context_var_name}. It should be a a positive integer. {custom_message}'
+                if not (val >= min_value and val <= max_value):
+                    raise ValueError(f"{context_var_name} must be an integer value between {min_value} and {max_value}")
+            except (TypeError, ValueError):
+                error_msg = f'Invalid value for {context_var_name}. It should be an integer between {min_value} and {max_value}. {custom_message}'
                 Annotations.of(self).add_error(error_msg)
                 return False
             else:
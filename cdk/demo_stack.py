@@ -1,16 +1,15 @@
 #!/usr/bin/env python3
 
+import hashlib
 import aws_cdk as cdk
 from constructs import Construct
 from aws_cdk import (
     aws_kms as kms,
     aws_iam as iam,
     aws_s3 as s3,
-    custom_resources as custom_resources,
     CfnOutput,
     Stack
 )
-from cdk_nag import NagSuppressions
 
 num_prefixes = 3
 
@@ -21,7 +20,7 @@ num_prefixes = 3
 #2. KMS Keys
 
 class DemoResourcesStack(Stack):
-    def __init__(self, scope: Construct, id: str, bucket_versioned = False, **kwargs) -> None:
+    def __init__(self, scope: Construct, id: str, bucket_versioned = False, run_cdk_nag = False, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
         ############################################
         #                  Bucket                  #
@@ -51,16 +50,18 @@ class DemoResourcesStack(Stack):
                     )
         CfnOutput(self, "S3BucketName", value=self.demo_bucket.bucket_name)
 
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            '/'+self.stack_name+'/prefix-level-keys-demo-bucket/Resource',
-            [
-                {
-                'id': 'AwsSolutions-S1',
-                'reason': 'This is only a demo bucket where nothing sensitive is being stored. Hence access logs are not enabled.',
-                },
-            ]
-        )
+        #cdk-nag suppressions are added only when the cdk-nag checks are run
+        if run_cdk_nag:
+            from cdk_nag import NagSuppressions
+            NagSuppressions.add_resource_suppressions(
+                self.demo_bucket.node.default_child,
+                [
+                    {
+                    'id': 'AwsSolutions-S1',
+                    'reason': 'This is only a demo bucket where nothing sensitive is being stored. Hence access logs are not enabled.',
+                    },
+                ]
+            )
         #---------------End of Bucket---------------
 
         ############################################
@@ -80,24 +81,29 @@ class DemoResourcesStack(Stack):
         )
 
 
+        #All the keys share the same policy, so it is rendered once and the result is passed to every key
+        key_policy_json = self.key_usage_policy.to_json()
+
         #KMS Keys for different Prefixes
         self.encryption_keys = []
         #Creating 10 different keys for demo purposes.
         for i in range(num_prefixes):
-            encryption_key = kms.Key(self, f"Key_for_prefix{i+1}",
+            #The L1 construct is used directly since none of the L2 helpers (aliases, grants) are needed for the demo keys
+            encryption_key = kms.CfnKey(self, f"Key_for_prefix{i+1}",
                 enable_key_rotation=True,
-                key_usage = kms.KeyUsage.ENCRYPT_DECRYPT,
-                policy = self.key_usage_policy,
-                #alias = f"Key_for_prefix{i+1}",
+                key_usage = "ENCRYPT_DECRYPT",
+                key_policy = key_policy_json,
             )
+            #Keep what the kms.Key L2 construct used to set, so that updating an already deployed demo stack does not replace (and schedule the deletion of) its keys:
+            #the Retain deletion and update replace policies, and the logical ID that the L2 derived from the path of its "Resource" child.
+            encryption_key.apply_removal_policy(cdk.RemovalPolicy.RETAIN)
+            encryption_key.override_logical_id(f"Keyforprefix{i+1}" + hashlib.md5(f"Key_for_prefix{i+1}/Resource".encode()).hexdigest()[:8].upper())
             self.encryption_keys.append(encryption_key)
-            #Add the key to the outputs section.
-            CfnOutput(self, f"Output_Key_for_prefix{i+1}", value = encryption_key.key_arn)
-
-            #Get KMS key's L1 construct and add a meta data explaining the use of "*" in the key usage policy
-            encryption_key_l1 = encryption_key.node.default_child
-            encryption_key_l1.add_metadata("Comment", "The use of '*' does not violate the principle of Least Privilege. This allows the account to use IAM to manage access to this key. Given so that the access to these keys are not locked out. Ref: https://docs.aws.amazon.com/kms/latest/developerguide/key-policy-overview.html#key-policy-example")
 
+            #Add a meta data explaining the use of "*" in the key usage policy
+            encryption_key.add_metadata("Comment", "The use of '*' does not violate the principle of Least Privilege. This allows the account to use IAM to manage access to this key. Given so that the access to these keys are not locked out. Ref: https://docs.aws.amazon.com/kms/latest/developerguide/key-policy-overview.html#key-policy-example")
 
+        #Add all the key ARNs to the outputs section as a single comma separated output, in the order of the prefixes.
+        CfnOutput(self, "KmsKeyArns", value = cdk.Fn.join(",", [encryption_key.attr_arn for encryption_key in self.encryption_keys]))
 
         #---------------End of KMS Keys---------------
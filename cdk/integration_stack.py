@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 from constructs import Construct
-from datetime import datetime
 from aws_cdk import (
     aws_iam as iam,
     aws_s3 as s3,
@@ -10,11 +10,31 @@ from aws_cdk import (
     aws_s3_notifications as s3n,
     NestedStack,
     RemovalPolicy,
-    CustomResource,
-    Annotations
+    CustomResource
 )
 
-from cdk_nag import NagSuppressions
+#Static parts of the inline policy added to the Lambda role for each bucket. Only the resources differ between buckets.
+_S3_ACCESS_STATEMENT = {
+    "Effect": "Allow",
+    "Action": [
+        "s3:PutObject",
+        "s3:GetObject",
+        "s3:GetObjectVersion",
+        "s3:ListBucket",
+        "s3:DeleteObject",
+        "s3:DeleteObjectVersion",
+        "s3:AbortMultipartUpload"
+    ]
+}
+
+_KMS_ACCESS_STATEMENT = {
+    "Effect": "Allow",
+    "Action": [
+        "kms:Encrypt",
+        "kms:Decrypt",
+        "kms:GenerateDataKey",
+    ]
+}
 
 #Each instance of this stack represents a single bucket whose prefix level keys are enforced by the core stack.
 #This stack will create the following resources:
@@ -52,52 +72,35 @@ class BucketIntegrationStack(NestedStack):
         ##################################################################################################
 
         #Get IAM Role ARN from core_stack
-        lambda_role_arn = self.core_stack.enforce_encryption_lambda_fn.role.role_arn
-        lambda_role_name = self.core_stack.enforce_encryption_lambda_fn.role.role_name
+        lambda_role_arn = self.core_stack.enforce_encryption_lambda_role_arn
+        lambda_role_name = self.core_stack.enforce_encryption_lambda_role_name
         
         #Generate bucket ARN from bucket name
         bucket_arn = f"arn:aws:s3:::{self.bucket_name}"
-        kms_key_arns = [mapping_data[prefix]['kms_key_arn'] for prefix in mapping_data]
+        #Prefixes commonly share a key, so duplicates are dropped. Sorting keeps the synthesized template stable between runs.
+        kms_key_arns = sorted({entry['kms_key_arn'] for entry in mapping_data.values()})
 
         #Generate policy document for the Lambda role to allow Lambda to write to the bucket and encrypt decrypt keys for the prefixes in the bucket.
         policy_document = {
             "Version": "2012-10-17",
             "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "s3:PutObject",
-                        "s3:GetObject",
-                        "s3:GetObjectVersion",
-                        "s3:ListBucket",
-                        "s3:DeleteObject",
-                        "s3:DeleteObjectVersion"
-                    ],
-                    "Resource": [
-                        bucket_arn,
-                        f"{bucket_arn}/*"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "kms:Encrypt",
-                        "kms:Decrypt",
-                        "kms:GenerateDataKey",
-                    ],
-                    "Resource": kms_key_arns
-                }
+                {**_S3_ACCESS_STATEMENT, "Resource": [bucket_arn, f"{bucket_arn}/*"]},
+                {**_KMS_ACCESS_STATEMENT, "Resource": kms_key_arns}
             ]
         }
 
+        #The physical id is derived from the policy, so the custom resource only runs again when the policy actually changes
+        policy_json = json.dumps(policy_document, sort_keys=True, separators=(',', ':'))
+        policy_physical_id = hashlib.sha256(policy_json.encode()).hexdigest()[:32]
+
         self.grant_lambda_s3_access_resource_call = custom_resources.AwsSdkCall(
             region = self.region,
             service = "IAM",
             action = "putRolePolicy",
             parameters = {'RoleName':lambda_role_name,
                           'PolicyName':f"permissions_for_bucket_{self.bucket_name}",
-                          'PolicyDocument':json.dumps(policy_document)},
-            physical_resource_id=custom_resources.PhysicalResourceId.of(datetime.now().strftime("%Y:%m:%d:%H:%M:%S:%f"))
+                          'PolicyDocument':policy_json},
+            physical_resource_id=custom_resources.PhysicalResourceId.of(policy_physical_id)
         )
 
         self.revoke_lambda_s3_access_resource_call = custom_resources.AwsSdkCall(
@@ -106,7 +109,7 @@ class BucketIntegrationStack(NestedStack):
             action = "deleteRolePolicy",
             parameters = {'RoleName':lambda_role_name, 
                           'PolicyName':f"permissions_for_bucket_{self.bucket_name}"},
-            physical_resource_id=custom_resources.PhysicalResourceId.of(datetime.now().strftime("%Y:%m:%d:%H:%M:%S:%f"))
+            physical_resource_id=custom_resources.PhysicalResourceId.of(policy_physical_id)
         )
 
         self.grant_lambda_s3_access_resource = custom_resources.AwsCustomResource(
@@ -120,61 +123,44 @@ class BucketIntegrationStack(NestedStack):
             )
         )
 
-        NagSuppressions.add_resource_suppressions_by_path(
-            #self.grant_lambda_s3_access_resource,
-            self,
-            f'/S3PrefixLevelKeys/{id}/AWS679f53fac002430cb0da5b7982bd2287/Resource',
-            suppressions = [
-                {
-                'id': 'AwsSolutions-L1',
-                'reason': 'The custom resource generates the Lambda Function. But that is outside the scope of this code',
-                }
-            ]
-        )
+        #cdk-nag suppressions are added only when the cdk-nag checks are run.
+        #The suppressions are added on the constructs directly rather than looking them up by path.
+        if self.core_stack.run_cdk_nag:
+            from cdk_nag import NagSuppressions
+            #The singleton Lambda function that AwsCustomResource adds to this stack
+            sdk_call_fn = self.node.find_child('AWS679f53fac002430cb0da5b7982bd2287')
+            NagSuppressions.add_resource_suppressions(
+                sdk_call_fn.node.find_child('Resource'),
+                suppressions = [
+                    {
+                    'id': 'AwsSolutions-L1',
+                    'reason': 'The custom resource generates the Lambda Function. But that is outside the scope of this code',
+                    }
+                ]
+            )
 
-        NagSuppressions.add_resource_suppressions_by_path(
-            #self.grant_lambda_s3_access_resource,
-            self,
-            f'/S3PrefixLevelKeys/{id}/AWS679f53fac002430cb0da5b7982bd2287/ServiceRole/Resource',
-            suppressions = [
-                {
-                'id': 'AwsSolutions-IAM4',
-                'reason': 'The custom resource generates the IAM role for the Lambda function. But that is outside the scope of this code',
-                }
-            ]
-        )
+            NagSuppressions.add_resource_suppressions(
+                sdk_call_fn.node.find_child('ServiceRole').node.find_child('Resource'),
+                suppressions = [
+                    {
+                    'id': 'AwsSolutions-IAM4',
+                    'reason': 'The custom resource generates the IAM role for the Lambda function. But that is outside the scope of this code',
+                    }
+                ]
+            )
 
         ###############################################################################################
         # Add event notification for S3 object creation pointing to the SQS queue in the core stack   #
         ###############################################################################################
 
-        s3_bucket = s3.Bucket.from_bucket_name(self, "S3Bucket", self.bucket_name)
+        #The notifications handler role is shared across all the integration stacks (see the core stack)
+        s3_bucket = s3.Bucket.from_bucket_attributes(self, "S3Bucket",
+                        bucket_name = self.bucket_name,
+                        region = self.region,
+                        account = self.account,
+                        notifications_handler_role = self.core_stack.shared_notifications_role)
 
         #Add event notification to the bucket so that events are sent to the SQS queue created in the core stack
         s3_bucket.add_event_notification(s3.EventType.OBJECT_CREATED, s3n.SqsDestination(self.core_stack.s3_objects_queue))
 
-        NagSuppressions.add_resource_suppressions_by_path(
-            #self.grant_lambda_s3_access_resource,
-            self,
-            f'/S3PrefixLevelKeys/{id}/BucketNotificationsHandler050a0587b7544547bf325f094a3db834/Role/Resource',
-            suppressions = [
-                {
-                'id': 'AwsSolutions-IAM4',
-                'reason': 'The add_event_notification function generates the Lambda function and the corresponding IAM Role. But that is outside the scope of this code',
-                }
-            ]
-        )
-
-        NagSuppressions.add_resource_suppressions_by_path(
-            #self.grant_lambda_s3_access_resource,
-            self,
-            f'/S3PrefixLevelKeys/{id}/BucketNotificationsHandler050a0587b7544547bf325f094a3db834/Role/DefaultPolicy/Resource',
-            suppressions = [
-                {
-                'id': 'AwsSolutions-IAM5',
-                'reason': "The add_event_notification function generates the Lambda function and the default policy for the function's IAM Role. But that is outside the scope of this code",
-                }
-            ]
-        )
-
         #------------End of Event Notification ------------
@@ -1,6 +1,34 @@
 import boto3
+from botocore.config import Config
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeSerializer
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
+import logging
+import time
+
+#The helper functions log the per item details at DEBUG level (skipped by default) and only a summary at INFO level.
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+#Writes to DynamoDB are I/O bound, so they are spread across a pool of threads.
+#Each thread writes one batch (of up to 25 items, which is the BatchWriteItem limit) at a time.
+MAX_WORKERS = 16
+BATCH_SIZE = 25
+#Number of times the unprocessed items of a batch are retried (with exponential backoff) before giving up
+MAX_BATCH_ATTEMPTS = 8
+
+#Adaptive retries (with a higher number of attempts than the default) ride out throttling on the table instead of failing the stack operation.
+#TCP keepalive keeps the connections open across the batched calls, and the pool is large enough for all the worker threads.
+_CFG = Config(retries = {'mode': 'adaptive', 'max_attempts': 10}, tcp_keepalive = True, max_pool_connections = MAX_WORKERS)
+
+#DynamoDB resource and tables used by the main thread. These are created once per Lambda container and reused across invocations.
+_DDB = boto3.resource('dynamodb', config = _CFG)
+_TABLES = {}
+
+#The batches are written with the low level client, which (unlike the resource) is thread safe and so can be shared by the worker threads.
+_DDB_CLIENT = _DDB.meta.client
+_SERIALIZER = TypeSerializer()
 
 #Entry point for creation, update, and deletion
 #Custom resource to handle mapping table updates.
@@ -43,10 +71,8 @@ def on_update(event):
 
     table = get_ddb_table(table_name)
     
-    #Update DDB items that are in mapping_data...
-    update_ddb_items(table, bucket_name, mapping_data)
-    #... and delete items that have been removed from mapping_data
-    delete_missing_ddb_items(table, bucket_name, mapping_data)
+    #Update DDB items that are in mapping_data and delete items that have been removed from mapping_data
+    reconcile_ddb_items(table, bucket_name, mapping_data)
 
     print(f"Updated resource {physical_id} with props {props}")
 
@@ -74,94 +100,129 @@ def on_delete(event):
 #Helper functions
 #================
 def insert_ddb_items(table, bucket_name, mapping_data):
-    with table.batch_writer() as batch:
-        for prefix in mapping_data:
-            kms_key_arn = mapping_data[prefix]['kms_key_arn']
-            dual_layer_encryption = mapping_data[prefix]['dual_layer_encryption']
-            #Add items that will be batched
-            curr_ts = datetime.datetime.strftime(datetime.datetime.now(datetime.timezone.utc),"%Y-%m-%d %H:%M:%S:%f%z")
-            batch.put_item(
-                            Item = {
-                                    'bucket_name': bucket_name,
-                                    'prefix': prefix,
-                                    'kms_key_arn': kms_key_arn,
-                                    'dual_layer_encryption' : dual_layer_encryption == 'true',
-                                    'insert_ts': curr_ts,
-                                    'last_update_ts': curr_ts
-                                }
-                            )
-    
-    print(f"Inserted {len(mapping_data)} items into DynamoDB table {table.table_name}")
+    #All the items inserted in one go get the same timestamp
+    curr_ts = datetime.datetime.strftime(datetime.datetime.now(datetime.timezone.utc),"%Y-%m-%d %H:%M:%S:%f%z")
+    items = []
+    for prefix, entry in mapping_data.items():
+        kms_key_arn = entry['kms_key_arn']
+        dual_layer_encryption = entry['dual_layer_encryption']
+        #Add items that will be batched
+        items.append({
+                        'bucket_name': bucket_name,
+                        'prefix': prefix,
+                        'kms_key_arn': kms_key_arn,
+                        'dual_layer_encryption' : dual_layer_encryption == 'true',
+                        'insert_ts': curr_ts,
+                        'last_update_ts': curr_ts
+                    })
+    batch_write_items(table, put_items = items)
+
+    log.info("Inserted %d items into DynamoDB table %s", len(mapping_data), table.table_name)
 
 def delete_ddb_items(table, bucket_name):
     items = query_table(table, key='bucket_name', value=bucket_name)
-    with table.batch_writer() as batch:
+    batch_write_items(table, delete_keys = [{'bucket_name': item['bucket_name'], 'prefix': item['prefix']} for item in items])
+    if log.isEnabledFor(logging.DEBUG):
         for item in items:
-            batch.delete_item(Key = item)
-            print(f"Deleted item {item}")
-    print(f"Deleted {len(items)} items from DynamoDB table {table.table_name}")
-
-def query_table(table, key=None, value=None):
+            log.debug("Deleted item %s", item)
+    log.info("Deleted %d items from DynamoDB table %s", len(items), table.table_name)
+
+#Writes the given items to and deletes the given keys from the table.
+#The requests are split into batches of BATCH_SIZE, and the batches are written in parallel by up to MAX_WORKERS threads.
+#A batch must not have a put and a delete for the same key, which is never the case for the callers in this file.
+def batch_write_items(table, put_items = (), delete_keys = ()):
+    requests = [('put', item) for item in put_items] + [('delete', key) for key in delete_keys]
+    if not requests:
+        return
+    batches = [requests[i:i + BATCH_SIZE] for i in range(0, len(requests), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers = min(MAX_WORKERS, len(batches))) as executor:
+        futures = [executor.submit(write_batch, table.table_name, batch) for batch in batches]
+        #Raise the first exception (if any) so that the custom resource fails
+        for future in as_completed(futures):
+            future.result()
+
+#Writes a single batch with BatchWriteItem. Any unprocessed items are retried as a batch (rather than one at a time) with exponential backoff.
+def write_batch(table_name, requests):
+    write_requests = []
+    for request_type, data in requests:
+        serialized = {k: _SERIALIZER.serialize(v) for k, v in data.items()}
+        if request_type == 'put':
+            write_requests.append({'PutRequest': {'Item': serialized}})
+        else:
+            write_requests.append({'DeleteRequest': {'Key': serialized}})
+
+    request_items = {table_name: write_requests}
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        response = _DDB_CLIENT.batch_write_item(RequestItems = request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+        #Back off only if there is another attempt to come
+        if attempt < MAX_BATCH_ATTEMPTS - 1:
+            time.sleep(0.05 * 2**attempt)
+    raise Exception(f"Could not write {len(request_items[table_name])} items to DynamoDB table {table_name} after {MAX_BATCH_ATTEMPTS} attempts")
+
+def query_table(table, key=None, value=None, projection='bucket_name, prefix'):
     #Use table.query to get all items in a DynamoDB table with a given partition key
-    response = table.query(
-        KeyConditionExpression=Key(key).eq(value),
-        Select = 'SPECIFIC_ATTRIBUTES',
-        ProjectionExpression = 'bucket_name, prefix'
-        )
+    #By default only the keys are fetched. Callers that need more attributes can pass in a wider projection.
+    #The same arguments are used for every page, so that the subsequent pages are projected too.
+    query_kwargs = {
+        'KeyConditionExpression': Key(key).eq(value),
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ProjectionExpression': projection
+    }
+    response = table.query(**query_kwargs)
     items = response['Items']
     while 'LastEvaluatedKey' in response:
-        response = table.query(
-            KeyConditionExpression=Key(key).eq(value),
-            ExclusiveStartKey = response['LastEvaluatedKey']
-            )
+        response = table.query(**query_kwargs, ExclusiveStartKey = response['LastEvaluatedKey'])
         items.extend(response['Items'])
-    print(f"Retrieved {len(items)} items from DynamoDB table {table.table_name}")
+    log.info("Retrieved %d items from DynamoDB table %s", len(items), table.table_name)
     return (items)
 
 def get_ddb_table(table_name):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(table_name)
+    table = _TABLES.get(table_name)
+    if table is None:
+        table = _TABLES[table_name] = _DDB.Table(table_name)
     return table
 
-def update_ddb_items(table, bucket_name, mapping_data):
-    #Go through every item in mapping data, and do an update. If the item does not exist, update_item just inserts the data
-    for prefix in mapping_data:
-        kms_key_arn = mapping_data[prefix]['kms_key_arn']
-        dual_layer_encryption = mapping_data[prefix]['dual_layer_encryption']
-
-        #Update the item in the DynamoDB table and ignore ConditionalCheckFailedException and ignore it.
-        #This way, any entries that already match what is in the mapping data are left untouched.
-        try:
-            table.update_item(
-                Key = {
-                    'bucket_name': bucket_name,
-                    'prefix': prefix
-                    },
-                    #Set the UPDATE expession in a way that insert_ts is updated only if the record does not already exist.
-                    UpdateExpression = "SET kms_key_arn = :k, dual_layer_encryption = :d, last_update_ts = :t, insert_ts = if_not_exists(insert_ts, :t)",
-                    ExpressionAttributeValues = {
-                        ':k': kms_key_arn,
-                        ':d': dual_layer_encryption == 'true',
-                        ':t': datetime.datetime.strftime(datetime.datetime.now(datetime.timezone.utc),"%Y-%m-%d %H:%M:%S:%f%z")
-                        },
-                    #Add the condition that the kms_key_arn or dual_layer_encryption is different. This ensures that unchanged entries in the mapping data are left untouched in DDB.
-                    ConditionExpression = "kms_key_arn <> :k or dual_layer_encryption <> :d"
-            )
-            print(f"Updated item {bucket_name}/{prefix} in DynamoDB table {table.table_name}")
-        except table.meta.client.exceptions.ConditionalCheckFailedException: #Ignore any failures because Condition was not met. That only means that the item did not need an update.
-            print(f"Item {bucket_name}/{prefix} in DynamoDB table {table.table_name} is already up to date. No update needed")
-    
-    print(f"Updated {len(mapping_data)} items in DynamoDB table {table.table_name}")
+def reconcile_ddb_items(table, bucket_name, mapping_data):
+    #Fetch the items that are already in the table for this bucket (with a single query), so that the comparison with mapping data can be done here.
+    existing = {item['prefix']: item for item in query_table(table, key='bucket_name', value=bucket_name, projection='prefix, kms_key_arn, dual_layer_encryption, insert_ts')}
+    curr_ts = datetime.datetime.strftime(datetime.datetime.now(datetime.timezone.utc),"%Y-%m-%d %H:%M:%S:%f%z")
+
+    put_items = []
+    delete_keys = []
+    #Go through every item in mapping data, and write only the ones that are new or have changed.
+    #This way, any entries that already match what is in the mapping data are left untouched.
+    for prefix, entry in mapping_data.items():
+        kms_key_arn = entry['kms_key_arn']
+        dual_layer_encryption = entry['dual_layer_encryption'] == 'true'
+
+        existing_item = existing.get(prefix)
+        if existing_item and existing_item.get('kms_key_arn') == kms_key_arn and existing_item.get('dual_layer_encryption') == dual_layer_encryption:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Item %s/%s in DynamoDB table %s is already up to date. No update needed", bucket_name, prefix, table.table_name)
+            continue
+
+        #insert_ts is retained from the existing item, if there is one.
+        put_items.append({
+                            'bucket_name': bucket_name,
+                            'prefix': prefix,
+                            'kms_key_arn': kms_key_arn,
+                            'dual_layer_encryption' : dual_layer_encryption,
+                            'insert_ts': existing_item.get('insert_ts', curr_ts) if existing_item else curr_ts,
+                            'last_update_ts': curr_ts
+                        })
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Updating item %s/%s in DynamoDB table %s", bucket_name, prefix, table.table_name)
 
-def delete_missing_ddb_items(table, bucket_name, mapping_data):
-    #Go through mapping_data and delete items from the table that are not in mapping_data
-    print(f"Deleting items from DynamoDB table {table.table_name} that are not in mapping_data for the bucket {bucket_name}")
-    items = query_table(table, key='bucket_name', value=bucket_name)
-    with table.batch_writer() as batch:
-        for item in items:
-            prefix = item['prefix']
-            if prefix not in mapping_data:
-                batch.delete_item(Key = item)
-                print(f"Deleted item {item} from DynamoDB table {table.table_name}")
+    #... and delete items that have been removed from mapping_data
+    for prefix in existing:
+        if prefix not in mapping_data:
+            delete_keys.append({'bucket_name': bucket_name, 'prefix': prefix})
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Deleting item %s/%s from DynamoDB table %s", bucket_name, prefix, table.table_name)
+
+    batch_write_items(table, put_items = put_items, delete_keys = delete_keys)
 
-    print(f"Deleted {len(items) - len(mapping_data)} items from DynamoDB table {table.table_name}")
+    log.info("Updated %d items and deleted %d items in DynamoDB table %s", len(put_items), len(delete_keys), table.table_name)
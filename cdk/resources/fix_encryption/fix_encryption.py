@@ -1,37 +1,109 @@
 import boto3
-import json
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
 import datetime
+import logging
+import threading
+import time
 
-ddb = boto3.client('dynamodb')
-s3 = boto3.client('s3')
+#The per object and per request details are logged at DEBUG level, which is skipped unless the environment variable log_level is set to DEBUG.
+#The level is set on this module's logger only (shared with s3_encrypt), not on the root logger, so that botocore and urllib3 do not log
+#requests and their signed headers. An unknown level falls back to INFO.
+log = logging.getLogger(__name__)
+_log_level = os.environ.get('log_level', 'INFO').upper()
+log.setLevel(_log_level if isinstance(logging.getLevelName(_log_level), int) else logging.INFO)
 
-def fix_encryption_if_incorrect(bucket_name, object_name, version_id = None):
+#Adaptive retries back off (and slow down this client) when S3 or DynamoDB throttle, e.g. with 503 SlowDown from S3.
+#A short connect timeout retries quickly on a slow connection. The read timeout is left at the default, as copying a large object can take a while.
+#The connection pool is shared by the handler's worker threads and the threads copying the parts of large objects, so it is larger than the default of 10.
+#TCP keepalive keeps the pooled connections open between the SQS batches handled by the same container, avoiding new TLS handshakes.
+_CFG = Config(retries = {'mode': 'adaptive', 'max_attempts': 10}, connect_timeout = 1, max_pool_connections = 128, tcp_keepalive = True)
+
+#Names of the DynamoDB tables, passed in by the stack as environment variables. These are read once per Lambda container.
+_LOG_TABLE = os.environ['ddb_log_table']
+_MAPPING_TABLE = os.environ['ddb_mapping_table']
+
+ddb = boto3.client('dynamodb', config = _CFG)
+s3 = boto3.client('s3', config = _CFG)
+
+#Limits the rate at which the S3 requests are sent by this Lambda container (S3 supports 3500 writes per second per prefix).
+#Each request takes a token, and the tokens are refilled at the given rate.
+class _TokenBucket:
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, **kwargs):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate) - 1
+            self._last = now
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        #Sleep outside the lock, so that the other threads can reserve their tokens in the meantime
+        if wait:
+            time.sleep(wait)
+
+#The rate can be changed with the environment variable s3_requests_per_second
+_S3_RATE_LIMITER = _TokenBucket(int(os.environ.get('s3_requests_per_second', '3000')))
+#Every S3 request (including the retries) takes a token before it is sent
+s3.meta.events.register('before-send.s3', _S3_RATE_LIMITER.acquire)
+
+#The mapping table changes rarely, so the prefixes of each bucket are cached in memory and reused across invocations of the same container.
+#bucket_name -> (time the prefixes were loaded, {prefix: kms key info}, distinct prefix lengths sorted longest first)
+_PREFIX_CACHE = {}
+#Number of seconds after which the prefixes of a bucket are read again from the mapping table
+_PREFIX_CACHE_TTL = 60
+#The objects are processed in threads, so each bucket has a lock that lets only one of them load its prefixes while the others wait for the result.
+#bucket_name -> lock. _PREFIX_CACHE_LOCKS_LOCK guards the creation of the locks.
+_PREFIX_CACHE_LOCKS = {}
+_PREFIX_CACHE_LOCKS_LOCK = threading.Lock()
+
+#The log items are buffered and written to the log table in batches (see flush_log_buffer) rather than one put_item per action.
+#Each entry is (messageId of the SQS message being processed, item), so that failed writes can be reported against that message.
+_LOG_BUFFER = []
+#BatchWriteItem accepts up to 25 items per request
+LOG_BATCH_SIZE = 25
+#Number of times the unprocessed items of a batch are retried (with exponential backoff) before giving up
+MAX_BATCH_ATTEMPTS = 8
+
+#The copies made by this container, so that their S3 events need not be checked with S3 again.
+#(bucket_name, object_name, version_id, etag) -> (sse_type, kms_key_arn). The oldest entries are removed once there are more than RECENT_COPIES_MAX_SIZE.
+_RECENT_COPIES = OrderedDict()
+_RECENT_COPIES_LOCK = threading.Lock()
+RECENT_COPIES_MAX_SIZE = 10000
+
+#Objects up to this size are copied with a single copy_object call. This is the largest object copy_object supports.
+MAX_COPY_OBJECT_SIZE = 5 * 1024**3
+#Larger objects are copied with a multipart upload, with parts of at least this size copied by this many threads
+MULTIPART_COPY_PART_SIZE = 512 * 1024**2
+MULTIPART_COPY_WORKERS = 10
+#The attributes of the object (from the head_object response) that are set on the multipart upload, as it does not copy them from the source
+COPIED_OBJECT_ATTRIBUTES = ('ContentType', 'Metadata', 'CacheControl', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage', 'StorageClass', 'WebsiteRedirectLocation')
+
+#message_id is the id of the SQS message that the object came from. It is recorded with the log items of the object.
+#etag is the ETag of the object from the S3 event (if available). It is used to recognize the events for the copies made by this function.
+def fix_encryption_if_incorrect(bucket_name, object_name, version_id = None, message_id = None, etag = None):
 
-    #Get the object from S3
     if version_id:
-        print(f"Fixing encryption for version {version_id} of {object_name} in {bucket_name}")
-        response = s3.get_object(Bucket=bucket_name, Key=object_name, VersionId=version_id)
+        log.debug("Fixing encryption for version %s of %s in %s", version_id, object_name, bucket_name)
         s3_object_path=f's3://{bucket_name}/{object_name}?versionId={version_id}'
     else:
-        print(f"Fixing encryption for {object_name} in {bucket_name}")
-        response = s3.get_object(Bucket=bucket_name, Key=object_name)
+        log.debug("Fixing encryption for %s in %s", object_name, bucket_name)
         s3_object_path=f's3://{bucket_name}/{object_name}'
 
-    #Get the encryption that is currently present on the object
-    current_sse_type = response['ResponseMetadata']['HTTPHeaders']['x-amz-server-side-encryption']
-    if 'x-amz-server-side-encryption-aws-kms-key-id' in response['ResponseMetadata']['HTTPHeaders']:
-        current_kms_key_arn = response['ResponseMetadata']['HTTPHeaders']['x-amz-server-side-encryption-aws-kms-key-id'] #Though HTTPHeaders has it as key-id,  it actually is the ARN
-    else:
-        current_kms_key_arn = None
-
     #Get the information on the encryption that the object "should" have as per the DDB Mapping table
     correct_kms_key_info = get_kms_key_info_for_s3_prefix(bucket_name, object_name)
 
     #If this objet is not configured to have a KMS key then log the information and return.
+    #This is checked before calling S3, so the current encryption of such objects is not looked up (and is logged as 'Not checked').
     if not correct_kms_key_info: #No key found for the prefix
-        print(f"{s3_object_path} is not configured to have a KMS key (as per the Mapping table in DynamoDB). Hence skipping")
-        log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type = 'None', new_kms_key_arn = 'None', action_taken = 'None', action_reason = 'No KMS key configured for this object\'s prefix')
+        log.info("%s is not configured to have a KMS key (as per the Mapping table in DynamoDB). Hence skipping", s3_object_path)
+        log_action_into_ddb(s3_object_path, current_sse_type = 'Not checked', current_kms_key_arn = None, new_sse_type = 'None', new_kms_key_arn = 'None', action_taken = 'None', action_reason = 'No KMS key configured for this object\'s prefix', message_id = message_id)
         return
 
     #Get the details of the "correct" encryption
@@ -42,130 +114,269 @@ def fix_encryption_if_incorrect(bucket_name, object_name, version_id = None):
     else:
         new_sse_type = 'aws:kms'
 
+    #If this is the event for a copy that this container made to fix the object's encryption, then the object is known to have the correct key and S3 is not called again.
+    if etag and _get_recent_copy(bucket_name, object_name, version_id, etag) == (new_sse_type, new_kms_key_arn):
+        log.info("%s was copied with the correct key %s by this function", s3_object_path, new_kms_key_arn)
+        log_action_into_ddb(s3_object_path, new_sse_type, new_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken = 'None', action_reason = 'Already using the correct key', message_id = message_id)
+        return
+
+    #Get the object's metadata from S3. Only the encryption headers are needed, so HEAD is used rather than GET to avoid downloading the body.
+    #If the object (or the version) no longer exists, there is nothing to fix. This also makes a redelivered message safe to process again
+    #after a versioned object was already fixed, since the old version was deleted. Without this, such messages would end up in the DLQ.
+    try:
+        if version_id:
+            response = s3.head_object(Bucket=bucket_name, Key=object_name, VersionId=version_id)
+        else:
+            response = s3.head_object(Bucket=bucket_name, Key=object_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NoSuchVersion'):
+            raise
+        log.info("%s no longer exists. Hence skipping", s3_object_path)
+        log_action_into_ddb(s3_object_path, current_sse_type = 'Not checked', current_kms_key_arn = None, new_sse_type = new_sse_type, new_kms_key_arn = new_kms_key_arn, action_taken = 'None', action_reason = 'Object no longer exists', message_id = message_id)
+        return
+
+    #Get the encryption that is currently present on the object
+    current_sse_type = response['ResponseMetadata']['HTTPHeaders']['x-amz-server-side-encryption']
+    if 'x-amz-server-side-encryption-aws-kms-key-id' in response['ResponseMetadata']['HTTPHeaders']:
+        current_kms_key_arn = response['ResponseMetadata']['HTTPHeaders']['x-amz-server-side-encryption-aws-kms-key-id'] #Though HTTPHeaders has it as key-id,  it actually is the ARN
+    else:
+        current_kms_key_arn = None
+
     #Check if current encryption matches the encryption the object ought to have
 
     #If the object is already encrypted with the correct key then the information and return
     if (current_sse_type == new_sse_type and current_kms_key_arn == new_kms_key_arn):
-        print(f"{s3_object_path} is already encrypted with the correct key {new_kms_key_arn}")
-        log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken = 'None', action_reason = 'Already using the correct key')
+        log.info("%s is already encrypted with the correct key %s", s3_object_path, new_kms_key_arn)
+        log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken = 'None', action_reason = 'Already using the correct key', message_id = message_id)
     else:
         #Current encryption is incorrect.
         if (current_sse_type != new_sse_type):
-            print(f"{s3_object_path} is not encrypted with the correct SSE type. x-amz-server-side-encryption is {current_sse_type} whereas it should be {new_sse_type}")
+            log.info("%s is not encrypted with the correct SSE type. x-amz-server-side-encryption is %s whereas it should be %s", s3_object_path, current_sse_type, new_sse_type)
             action_reason = f'Incorrect SSE type. Was {current_sse_type} whereas it should have been {new_sse_type}'
         elif (current_kms_key_arn != new_kms_key_arn):
-            print(f"{s3_object_path} is not encrypted with the correct KMS key. x-amz-server-side-encryption-aws-kms-key-id is {current_kms_key_arn} whereas it should be {new_kms_key_arn}")
+            log.info("%s is not encrypted with the correct KMS key. x-amz-server-side-encryption-aws-kms-key-id is %s whereas it should be %s", s3_object_path, current_kms_key_arn, new_kms_key_arn)
             action_reason = f'Incorrect KMS key. Was {current_kms_key_arn} whereas it should hve been {new_kms_key_arn}'
-        print("Hence initiating copy to encrypt with the correct key now.")
+        log.info("Hence initiating copy to encrypt with the correct key now.")
 
         #Initiating copy to fix the key
         if version_id:
             #Create a new version with the right encryption and log it
-            #response = s3.copy(Bucket = bucket_name, Key = object_name, CopySource= {'Bucket': bucket_name, 'Key': object_name, 'VersionId': version_id}, ExtraArgs = { 'SSEKMSKeyId' : new_kms_key_arn, 'ServerSideEncryption' : new_sse_type })
-            #copy_object works only on files up to 5 GB. Ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy_object.html. But copy uses MPU under the hood if needed.
-            #Using copy_object here as it returns the New Version Id.
-            response=s3.copy_object(Bucket = bucket_name, Key = object_name, CopySource= {'Bucket': bucket_name, 'Key': object_name, 'VersionId': version_id}, SSEKMSKeyId = new_kms_key_arn, ServerSideEncryption = new_sse_type)
-            new_version_id = response['VersionId']
-            log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken = 'Initiated copy with the right key', action_reason = action_reason, new_version_id = new_version_id)
+            new_version_id = _server_side_copy(bucket_name, object_name, version_id, new_kms_key_arn, new_sse_type, response)
+            log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken = 'Initiated copy with the right key', action_reason = action_reason, new_version_id = new_version_id, message_id = message_id)
 
             #Delete the old version and log it
             s3.delete_object(Bucket = bucket_name, Key = object_name, VersionId = version_id)
-            log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type='N/A', new_kms_key_arn='N/A', action_taken = 'Deleted old version with incorrect encryption', action_reason = 'N/A')
+            log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type='N/A', new_kms_key_arn='N/A', action_taken = 'Deleted old version with incorrect encryption', action_reason = 'N/A', message_id = message_id)
         else:
             #Non-versioned. Just copy the object and log it.
-            s3.copy(Bucket = bucket_name, Key = object_name, CopySource= {'Bucket': bucket_name, 'Key': object_name}, ExtraArgs = { 'SSEKMSKeyId' : new_kms_key_arn, 'ServerSideEncryption' : new_sse_type })
-            log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken = 'Initiated copy with the right key', action_reason = action_reason)
+            _server_side_copy(bucket_name, object_name, None, new_kms_key_arn, new_sse_type, response)
+            log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken = 'Initiated copy with the right key', action_reason = action_reason, message_id = message_id)
 
     return
 
-def log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken, action_reason, new_version_id = None):
+#Copies the object (or the given version of it) onto itself with the given encryption, entirely within S3. Returns the VersionId of the copy (None for unversioned buckets).
+#head_response is the response of head_object for the object. It provides the size and the metadata of the object.
+#copy_object works only on objects up to 5 GB. Ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy_object.html
+#Larger objects are copied with a multipart upload whose parts are copied in parallel with upload_part_copy.
+def _server_side_copy(bucket_name, object_name, version_id, kms_key_arn, sse_type, head_response):
+    copy_source = {'Bucket': bucket_name, 'Key': object_name}
+    if version_id:
+        copy_source['VersionId'] = version_id
+
+    object_size = head_response['ContentLength']
+    if object_size <= MAX_COPY_OBJECT_SIZE:
+        #copy_object copies the metadata and tags of the object as is
+        response = s3.copy_object(Bucket = bucket_name, Key = object_name, CopySource = copy_source, SSEKMSKeyId = kms_key_arn, ServerSideEncryption = sse_type)
+        _add_recent_copy(bucket_name, object_name, response.get('VersionId'), response['CopyObjectResult']['ETag'], sse_type, kms_key_arn)
+        return response.get('VersionId')
+
+    #A multipart upload does not copy the metadata of the source, so it is passed in from the head_object response
+    extra_args = {k: head_response[k] for k in COPIED_OBJECT_ATTRIBUTES if head_response.get(k)}
+    upload_id = s3.create_multipart_upload(Bucket = bucket_name, Key = object_name, SSEKMSKeyId = kms_key_arn, ServerSideEncryption = sse_type, **extra_args)['UploadId']
 
-    log_table_name = os.environ['ddb_log_table']
+    #A multipart upload can have at most 10000 parts
+    part_size = max(MULTIPART_COPY_PART_SIZE, -(-object_size // 10000))
+    part_ranges = [(part_number, start, min(start + part_size, object_size) - 1) for part_number, start in enumerate(range(0, object_size, part_size), start = 1)]
 
-    if not current_kms_key_arn:
-        current_kms_key_arn = 'None'
+    #The ETag makes sure that all the parts are copied from the same object, in case it is overwritten while being copied
+    def copy_part(part_range):
+        part_number, first_byte, last_byte = part_range
+        response = s3.upload_part_copy(Bucket = bucket_name, Key = object_name, CopySource = copy_source, CopySourceIfMatch = head_response['ETag'],
+                                       CopySourceRange = f'bytes={first_byte}-{last_byte}', PartNumber = part_number, UploadId = upload_id)
+        return {'ETag': response['CopyPartResult']['ETag'], 'PartNumber': part_number}
 
-    print(f"Logging information about {s3_object_path} into {log_table_name}. {action_taken}")
+    try:
+        with ThreadPoolExecutor(max_workers = MULTIPART_COPY_WORKERS) as executor:
+            parts = list(executor.map(copy_part, part_ranges))
+        response = s3.complete_multipart_upload(Bucket = bucket_name, Key = object_name, UploadId = upload_id, MultipartUpload = {'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket = bucket_name, Key = object_name, UploadId = upload_id)
+        raise
+    _add_recent_copy(bucket_name, object_name, response.get('VersionId'), response['ETag'], sse_type, kms_key_arn)
+    return response.get('VersionId')
 
-    #Create the item
+#Records a copy made by _server_side_copy, so that the S3 event for that copy can be recognized (see fix_encryption_if_incorrect).
+#The ETag of an object encrypted with SSE-KMS is different for every write, so together with the version id it identifies this copy.
+def _add_recent_copy(bucket_name, object_name, version_id, etag, sse_type, kms_key_arn):
+    with _RECENT_COPIES_LOCK:
+        _RECENT_COPIES[(bucket_name, object_name, version_id, etag.strip('"'))] = (sse_type, kms_key_arn)
+        if len(_RECENT_COPIES) > RECENT_COPIES_MAX_SIZE:
+            _RECENT_COPIES.popitem(last = False)
+
+#Returns (sse_type, kms_key_arn) of the copy made by this container, if the given object is one.
+def _get_recent_copy(bucket_name, object_name, version_id, etag):
+    with _RECENT_COPIES_LOCK:
+        return _RECENT_COPIES.get((bucket_name, object_name, version_id, etag.strip('"')))
+
+#Builds the log item and adds it to the log buffer. The buffer is written to the log table by flush_log_buffer.
+def log_action_into_ddb(s3_object_path, current_sse_type, current_kms_key_arn, new_sse_type, new_kms_key_arn, action_taken, action_reason, new_version_id = None, message_id = None):
+
+    log.debug("Logging information about %s. %s", s3_object_path, action_taken)
+
+    #Create the item. Missing values (e.g. current_kms_key_arn for objects not encrypted with KMS) are logged as 'None'
     item = {
-            's3_object_path': {
-                'S': s3_object_path
-            },
+            's3_object_path': _S(s3_object_path),
             #Current timestamp with time zone
-            'current_timestamp_utc': {
-                'S': datetime.datetime.strftime(datetime.datetime.now(datetime.timezone.utc),"%Y-%m-%d %H:%M:%S:%f%z")
-            },
-            'current_sse_type': {
-                'S': current_sse_type
-            },
-            'current_kms_key_arn': {
-                'S': current_kms_key_arn
-            },
-            'new_sse_type': {
-                'S': new_sse_type
-            },
-            'new_kms_key_arn': {
-                'S': new_kms_key_arn
-            },
-            'action_taken': {
-                'S': action_taken
-            },
-            'action_reason': {
-                'S': action_reason
-            }
+            'current_timestamp_utc': _S(current_timestamp_utc()),
+            'current_sse_type': _S(current_sse_type),
+            'current_kms_key_arn': _S(current_kms_key_arn),
+            'new_sse_type': _S(new_sse_type),
+            'new_kms_key_arn': _S(new_kms_key_arn),
+            'action_taken': _S(action_taken),
+            'action_reason': _S(action_reason)
         }
 
     #If this is a versioned object, then also log the new version id    
     if new_version_id:
-        item['new_version_id'] = {
-            'S': new_version_id
-        }
+        item['new_version_id'] = _S(new_version_id)
 
-    #Insert the item into the DDB table
-    ddb.put_item(TableName = log_table_name, Item = item)
+    #Add the item to the buffer. list.append is atomic, so this is safe to call from multiple threads.
+    _LOG_BUFFER.append((message_id, item))
     return
 
+#Returns the given value as a DynamoDB string attribute
+def _S(value):
+    return {'S': value or 'None'}
+
+#Returns the current UTC time in the format of the log table's sort key, e.g. 2023-11-01 14:14:16:116264+0000
+#This is the same as strftime with "%Y-%m-%d %H:%M:%S:%f%z", but isoformat is about 1.5 times as fast. The offset is always +0000 as the time is in UTC.
+def current_timestamp_utc():
+    iso = datetime.datetime.now(datetime.timezone.utc).isoformat(' ', 'microseconds')
+    return f"{iso[:19]}:{iso[20:26]}+0000"
+
+#Discards anything left in the log buffer, e.g. by an earlier invocation that failed before flushing it.
+def clear_log_buffer():
+    _LOG_BUFFER.clear()
+
+#Writes all the buffered log items to the log table with BatchWriteItem and empties the buffer.
+#Returns the set of message ids whose log items could not be written.
+def flush_log_buffer():
+    log_table_name = _LOG_TABLE
+    entries = _LOG_BUFFER[:]
+    del _LOG_BUFFER[:len(entries)]
+
+    #Split the entries into batches. A batch cannot have two items with the same key, so such an item starts a new batch.
+    batches = []
+    batch = {}
+    for message_id, item in entries:
+        key = (item['s3_object_path']['S'], item['current_timestamp_utc']['S'])
+        if len(batch) == LOG_BATCH_SIZE or key in batch:
+            batches.append(batch)
+            batch = {}
+        batch[key] = (message_id, item)
+    if batch:
+        batches.append(batch)
+
+    failed_message_ids = set()
+    for batch in batches:
+        try:
+            unprocessed_items = write_log_batch(log_table_name, [item for _, item in batch.values()])
+        except Exception as e:
+            log.error("Failed to write %d items to %s. Error: %s", len(batch), log_table_name, e)
+            unprocessed_items = [item for _, item in batch.values()]
+        for item in unprocessed_items:
+            failed_message_ids.add(batch[(item['s3_object_path']['S'], item['current_timestamp_utc']['S'])][0])
+
+    log.info("Logged %d items into %s in %d batches", len(entries), log_table_name, len(batches))
+    return failed_message_ids
+
+#Writes a single batch of items with BatchWriteItem. Any unprocessed items are retried as a batch with exponential backoff.
+#Returns the items that are still unprocessed after MAX_BATCH_ATTEMPTS attempts.
+def write_log_batch(table_name, items):
+    request_items = {table_name: [{'PutRequest': {'Item': item}} for item in items]}
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        response = ddb.batch_write_item(RequestItems = request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return []
+        #Back off only if there is another attempt to come
+        if attempt < MAX_BATCH_ATTEMPTS - 1:
+            time.sleep(0.05 * 2**attempt)
+    return [request['PutRequest']['Item'] for request in request_items[table_name]]
+
 #This function finds the best match for the prefix in the prefix-kms-key-mapping-table.
 def get_kms_key_info_for_s3_prefix(bucket_name, object_name):
-    print(f"Getting KMS key info for {bucket_name}/{object_name}")
-    #Get all entries from the DynamoDB table whose prefixes are "<=" the object that was uploaded.
-    #This ensures that most specific prefixes are listed first.
-    #For example, if the table has entries for the prefixes "prefix1/b", "prefix1/bb" and "prefix1/bba",
-    #then this query will fetch the prefixes in the order prefix1/bba, prefix1/bb, prefix1/b when looking for an object like prefix1/bbcdef.txt
-    table_name = os.environ['ddb_mapping_table']
-    result = ddb.query(TableName = table_name,
-                ExpressionAttributeValues={
-                    ':bucket_name': {
-                        'S': bucket_name,
-                    },
-                    ':object_name': {
-                        'S': object_name,
-                    },
-                },
-                KeyConditionExpression='bucket_name = :bucket_name and prefix <= :object_name',
-                Select='ALL_ATTRIBUTES',
-                ScanIndexForward = False
-            )
-    print(f"Output from DDB: {result}")
+    log.debug("Getting KMS key info for %s/%s", bucket_name, object_name)
+    prefix_map, prefix_lengths = get_prefixes_for_bucket(bucket_name)
 
-    #Even when the most specific prefixes are fixed, that prefix might not match the prefix of qthe object that was uploaded.
-    #Continuing the example from above, prefix1/bbcdef.txt might not have the prefix prefix1/bba (the first listed item) in it.
-    #Thus, we need to find the best match for the prefix that was uploaded by going through the results one at a time.
-    #This ensures that prefix1/bb is picked for this object.
+    #The most specific (longest) prefix that the object starts with is the best match.
+    #For example, if the table has entries for the prefixes "prefix1/b", "prefix1/bb" and "prefix1/bba",
+    #then for an object like prefix1/bbcdef.txt its leading 11, 10 and 9 characters (prefix1/bbc, prefix1/bb, prefix1/b) are looked up in that order.
+    #This ensures that prefix1/bb is picked for this object. Each check is a dictionary lookup, so the cost depends on the number of distinct prefix lengths and not on the number of prefixes.
     #Once a match is found, exit out of the loop.
     kms_key_info = None
-    for item in result['Items']:
-        if object_name.startswith(item['prefix']['S']):
-            kms_key_arn = item['kms_key_arn']['S']
-            dual_layer_encryption = item['dual_layer_encryption']['BOOL']
-            kms_key_info = { 'kms_key_arn': kms_key_arn, 'dual_layer_encryption': dual_layer_encryption }
-            break
+    for prefix_length in prefix_lengths:
+        if prefix_length <= len(object_name):
+            kms_key_info = prefix_map.get(object_name[:prefix_length])
+            if kms_key_info:
+                break
     
     #If no KMS key is found, you could choose to raise an Exception, so that the object can be sent to the DLQ. This can be used if you need every prefix in a bucket is to be mapped to some key
     #if not kms_key_info:
     #    err_msg = f"No kms key found for object {object_name} in bucket {bucket_name}"
-    #    print(err_msg)
+    #    log.error(err_msg)
     #    raise Exception(err_msg)
 
     return(kms_key_info)
+
+#This function returns all the prefixes of a bucket from the mapping table as a dictionary of prefix -> kms key info,
+#along with the distinct lengths of those prefixes, longest first.
+#The prefixes are read from the cache if they were loaded less than _PREFIX_CACHE_TTL seconds ago.
+def get_prefixes_for_bucket(bucket_name):
+    cached = _PREFIX_CACHE.get(bucket_name)
+    if cached and time.monotonic() - cached[0] < _PREFIX_CACHE_TTL:
+        return cached[1], cached[2]
+
+    with _PREFIX_CACHE_LOCKS_LOCK:
+        bucket_lock = _PREFIX_CACHE_LOCKS.setdefault(bucket_name, threading.Lock())
+    with bucket_lock:
+        #Another thread may have loaded the prefixes while this one was waiting for the lock
+        cached = _PREFIX_CACHE.get(bucket_name)
+        if cached and time.monotonic() - cached[0] < _PREFIX_CACHE_TTL:
+            return cached[1], cached[2]
+        return _load_prefixes_for_bucket(bucket_name)
+
+#Reads all the prefixes of a bucket from the mapping table and stores them in the cache. Called by get_prefixes_for_bucket with the bucket's lock held.
+def _load_prefixes_for_bucket(bucket_name):
+    table_name = _MAPPING_TABLE
+    paginator = ddb.get_paginator('query')
+    pages = paginator.paginate(TableName = table_name,
+                ExpressionAttributeValues={
+                    ':bucket_name': {
+                        'S': bucket_name,
+                    },
+                },
+                KeyConditionExpression='bucket_name = :bucket_name',
+                #Only the attributes that are used are read
+                ProjectionExpression='prefix, kms_key_arn, dual_layer_encryption'
+            )
+    prefix_map = {}
+    for page in pages:
+        log.debug("Output from DDB: %s", page)
+        for item in page['Items']:
+            prefix_map[item['prefix']['S']] = { 'kms_key_arn': item['kms_key_arn']['S'], 'dual_layer_encryption': item['dual_layer_encryption']['BOOL'] }
+    prefix_lengths = sorted({len(prefix) for prefix in prefix_map}, reverse = True)
+
+    log.info("Loaded %d prefixes for %s from %s", len(prefix_map), bucket_name, table_name)
+    _PREFIX_CACHE[bucket_name] = (time.monotonic(), prefix_map, prefix_lengths)
+    return prefix_map, prefix_lengths
@@ -1,15 +1,62 @@
 import urllib.parse
-from fix_encryption import fix_encryption_if_incorrect
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+#The logger (and its level) is set up in fix_encryption
+from fix_encryption import fix_encryption_if_incorrect, clear_log_buffer, flush_log_buffer, log
+import os
+
+#Use orjson to parse the message bodies if it is available (e.g. from a Lambda layer), as it is faster than the standard json library.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
+
+#The objects are processed in parallel, as the work for each object is mostly waiting on S3 and DynamoDB.
+#The boto3 clients in fix_encryption are shared by the threads, which is safe for clients (unlike sessions and resources).
+MAX_WORKERS = int(os.environ.get('max_workers', '16'))
+
+#The sequencers of the S3 events are hexadecimal strings of varying length. They are left padded with zeros to this length before being compared.
+SEQUENCER_LENGTH = 64
+
+#Returns the sequencer of the S3 event record, zero padded so that sequencers of different lengths compare correctly as strings.
+#For events of the same object, a larger sequencer means a later event. Returns None if the record does not have one.
+def _sequencer(rec):
+    sequencer = rec['s3']['object'].get('sequencer')
+    if not sequencer:
+        return None
+    return sequencer.rjust(SEQUENCER_LENGTH, '0')
+
+#Processes the tasks of one object (one per version) in the order of their events. Returns (messageId, rec, error) for each task, where error is None on success.
+#If a version fails, the later versions are not processed but reported as failed, so that they are retried after it rather than overtaken by it.
+def _process_object(object_task_list):
+    results = []
+    error = None
+    for message_id, rec, bucket_name, object_name, version_id, etag in sorted(object_task_list, key = lambda task: _sequencer(task[1]) or ''):
+        if error is None:
+            try:
+                #This is the call that fixes the encryption of the object. If the encryption is incorrect, it will fix it. If it is correct, it will do nothing.
+                fix_encryption_if_incorrect(bucket_name, object_name, version_id=version_id, message_id=message_id, etag=etag)
+            except Exception as e:
+                error = e
+        results.append((message_id, rec, error))
+    return results
 
 #Handles messages from the SQS queue.
 def lambda_handler(event, context):
-    print(f"Received event: {event}")
+    log.debug("Received event: %s", event)
     batch_item_failures = []
+    clear_log_buffer()
 
-    # Get the messages from the event and process them. If successful, append to processed_messages, if not append to failed_messages else append to failed_messages
+    # Get the objects from the messages in the event. Each task is (messageId, rec, bucket_name, object_name, version_id, etag)
+    # If the same object (or the same version of it) appears more than once, e.g. when it is overwritten repeatedly, only its latest event is processed.
+    # Neither S3 notifications nor SQS keep the events in order, so the latest event is the one with the largest sequencer, not the last one in the batch.
+    # The latest event covers the earlier ones, as it describes the object as it is now. The messages of the earlier events are treated as processed.
+    # Different versions of an object are all processed, because each version has its own encryption.
+    tasks = {}
+    skipped_records = 0
     for sqs_msg in event['Records']: #When updating the event notification configuration on a bucket, a test event is sent. In that case, it will not have a "Records" item in the "body". This if statement handles that
-        s3_recs = json.loads(sqs_msg['body'])
+        s3_recs = _json_loads(sqs_msg['body'])
         if 'Records' in s3_recs:
             #Each rec represents a single object that has been uploaded to the bucket
             for rec in s3_recs["Records"]:         #As of today only a separate event is triggered for each objet in S3, but creating a loop just to be sure.
@@ -18,21 +65,58 @@ def lambda_handler(event, context):
                 version_id = None
                 if 'versionId' in rec['s3']['object']:
                     version_id = rec['s3']['object']['versionId']
-                try:
-                    #This is the call that fixes the encryption of the object. If the encryption is incorrect, it will fix it. If it is correct, it will do nothing.
-                    fix_encryption_if_incorrect(bucket_name, object_name, version_id=version_id)
-                    print(f"Processed message: {rec}")
-                except Exception as e:
-                    batch_item_failures.append({'itemIdentifier': sqs_msg['messageId']})
-                    print(f"Failed to process message: {rec}")
-                    print(f"Error: {e}")
+                etag = rec['s3']['object'].get('eTag')
+                task_key = (bucket_name, object_name, version_id)
+                if task_key in tasks:
+                    skipped_records += 1
+                    earlier_sequencer = _sequencer(tasks[task_key][1])
+                    sequencer = _sequencer(rec)
+                    if earlier_sequencer and sequencer:
+                        if sequencer < earlier_sequencer:
+                            continue
+                    else:
+                        #Without sequencers it is not known which event is the latest. Keep this one, but without the ETag,
+                        #so that the object's encryption is read from S3 rather than trusted from a copy made by this function.
+                        etag = None
+                tasks[task_key] = (sqs_msg['messageId'], rec, bucket_name, object_name, version_id, etag)
         else:
-            print(f"No records found in {sqs_msg}. Hence ignored")
+            log.info("No records found in %s. Hence ignored", sqs_msg)
             continue
 
+    if skipped_records:
+        log.info("Skipped %d records for objects that appear again later in this batch", skipped_records)
+
+    # Fixing a version copies it over the object, which makes the copy the current version. The versions of an object are therefore processed
+    # one after another, in the order of their events, so that the latest version stays the current one. Different objects are processed in parallel.
+    object_tasks = {}
+    for task in tasks.values():
+        object_tasks.setdefault((task[2], task[3]), []).append(task)
+
+    # Process the objects. If one fails, the message it came from is reported as a failure (once, even if several of its objects fail).
+    reported_message_ids = set()
+    if object_tasks:
+        with ThreadPoolExecutor(max_workers = min(MAX_WORKERS, len(object_tasks))) as executor:
+            futures = [executor.submit(_process_object, object_task_list) for object_task_list in object_tasks.values()]
+            for future in as_completed(futures):
+                for message_id, rec, error in future.result():
+                    if error is None:
+                        log.debug("Processed message: %s", rec)
+                        continue
+                    if message_id not in reported_message_ids:
+                        batch_item_failures.append({'itemIdentifier': message_id})
+                        reported_message_ids.add(message_id)
+                    log.error("Failed to process message: %s", rec)
+                    log.error("Error: %s", error)
+
+    #Write the log items of all the messages. The messages whose log items could not be written are reported as failures too.
+    for message_id in flush_log_buffer():
+        if message_id and message_id not in reported_message_ids:
+            batch_item_failures.append({'itemIdentifier': message_id})
+            reported_message_ids.add(message_id)
+
     #If there have been failures, report back with a status of 500. If not report back with 200
     if len(batch_item_failures) == 0:
-        print(f"All objects successfully processed")
+        log.info("All %d objects successfully processed", len(tasks))
         return {
             "statusCode": 200,
         }
@@ -41,5 +125,5 @@ def lambda_handler(event, context):
             "statusCode": 500,
             "batchItemFailures": batch_item_failures
         }
-        print(f"There were some failures. Returning {response}")
+        log.warning("There were some failures. Returning %s", response)
         return(response)